@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+# Micro-benchmark of the per-packet cost of marshalling GATT payloads to and
+# from D-Bus messages. No bus connection is needed: messages are built and
+# parsed in-process.
+#
+# Sending compares plain bytes (what tealblue sends) with dbus.ByteArray, to
+# check whether wrapping is worth the extra copy. Receiving compares unpacking
+# into dbus.Byte objects plus the old bytes() conversions with byte_arrays.
+
+import dbus
+import dbus.lowlevel
+import timeit
+import sys
+
+PAYLOAD_SIZE = 20
+ITERATIONS = 20000
+
+def write_message(value):
+    msg = dbus.lowlevel.MethodCallMessage('org.bluez', '/org/bluez/hci0/dev/char',
+                                          'org.bluez.GattCharacteristic1', 'WriteValue')
+    msg.append(value, {}, signature='aya{sv}')
+    return msg
+
+def notify_message(payload):
+    msg = dbus.lowlevel.SignalMessage('/org/bluez/hci0/dev/char',
+                                      'org.freedesktop.DBus.Properties', 'PropertiesChanged')
+    msg.append('org.bluez.GattCharacteristic1', {'Value': dbus.ByteArray(payload)}, [],
+               signature='sa{sv}as')
+    return msg
+
+def send_bytes(payload):
+    # A bytes slice, as sliced from the page in dfu.py. dbus-python appends
+    # bytes as a single 'ay' block.
+    write_message(payload[0:PAYLOAD_SIZE])
+
+def send_byte_array(payload):
+    write_message(dbus.ByteArray(payload[0:PAYLOAD_SIZE]))
+
+def receive_before(msg):
+    # The signal is unpacked into one dbus.Byte per element, then converted
+    # in Characteristic._on_prop_changed and again in the notify handler.
+    interface, changed, invalidated = msg.get_args_list()
+    value = bytes(changed['Value'])
+    return bytes(value)
+
+def receive_after(msg):
+    interface, changed, invalidated = msg.get_args_list(byte_arrays=True)
+    return changed['Value']
+
+def bench(name, func, arg):
+    duration = min(timeit.repeat(lambda: func(arg), number=ITERATIONS, repeat=5))
+    usec = duration / ITERATIONS * 1e6
+    print('%-16s %6.2fus per packet' % (name, usec))
+    return usec
+
+def main():
+    global PAYLOAD_SIZE
+    if len(sys.argv) > 1:
+        PAYLOAD_SIZE = int(sys.argv[1])
+    payload = bytes(range(256)) * (PAYLOAD_SIZE // 256 + 1)
+    payload = payload[:PAYLOAD_SIZE]
+    msg = notify_message(payload)
+    assert receive_before(msg) == receive_after(msg) == payload
+
+    print('payload size: %d bytes' % PAYLOAD_SIZE)
+    before = bench('send bytes', send_bytes, payload)
+    after = bench('send ByteArray', send_byte_array, payload)
+    print('%-16s %6.1fx' % ('ByteArray gain', before / after))
+    before = bench('receive before', receive_before, msg)
+    after = bench('receive after', receive_after, msg)
+    print('%-16s %6.1fx' % ('receive speedup', before / after))
+
+if __name__ == '__main__':
+    main()
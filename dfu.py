@@ -4,8 +4,11 @@ import tealblue
 import sys
 import struct
 import math
-import threading
 import time
+import threading
+import functools
+import json
+import os
 
 DFU_SERVICE_UUID          = '67fc0001-83ae-f58c-f84b-ba72efb822f4'
 DFU_CHARACTERISTIC_INFO   = '67fc0002-83ae-f58c-f84b-ba72efb822f4'
@@ -19,6 +22,10 @@ COMMAND_ADD_BUFFER   = 0x04
 COMMAND_PING         = 0x10
 COMMAND_START        = 0x11
 
+# Learned pacing parameters per device address, to seed the next session.
+# Set to None to disable.
+PACING_FILE = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'pynus', 'dfu-pacing.json')
+
 class DFUInfo:
     def __init__(self, data):
         info = struct.unpack('BBH4sHH', data)
@@ -52,6 +59,167 @@ class Block:
                 yield Block(address, self.data[i:i+pagesize])
                 address += pagesize
 
+class Pacer:
+    '''
+    Streams data to a characteristic, adjusting the chunk size and in-flight
+    depth in AIMD style: both grow additively while writes complete quickly
+    and are cut in half on slow writes, errors or slow notification round
+    trips.
+
+    Multiple writes are only kept in flight when they are sent as write
+    commands (for write-without-response characteristics). BlueZ allows only
+    one pending write request per characteristic.
+    '''
+    MIN_CHUNK  = 4
+    MAX_DEPTH  = 16
+    # Well below the 0.5s after which Characteristic.write suspects a broken
+    # connection.
+    SLOW_WRITE = 0.25
+    # Upper bound on waiting for the last writes of a send() to complete,
+    # well above the timeout of a single write.
+    DRAIN_TIMEOUT = 10
+
+    def __init__(self, max_chunk=20, chunk_size=None, depth=1):
+        self.max_chunk = max_chunk
+        self.chunk_size = min(chunk_size or max_chunk, max_chunk)
+        self.depth = max(1.0, min(float(depth), self.MAX_DEPTH))
+        self.srtt = None
+        self._cond = threading.Condition()
+        self._in_flight = 0
+        self._error = None
+        self._seq = 0
+        self._recover_seq = 0
+        self._generation = 0
+        self._pipelined = False
+
+    def __repr__(self):
+        return '<dfu.Pacer chunk_size=%d depth=%.1f>' % (self.chunk_size, self.depth)
+
+    def send(self, characteristic, data):
+        '''
+        Write data in chunks and wait until all writes have completed. On
+        failure the first error is raised. Writes that were in flight at that
+        time may or may not have arrived.
+        '''
+        command = 'write-without-response' in characteristic.flags
+        with self._cond:
+            self._generation += 1
+            generation = self._generation
+            self._error = None
+            self._pipelined = command
+            if not command:
+                self.depth = 1.0
+
+        offset = 0
+        while offset < len(data):
+            with self._cond:
+                self._cond.wait_for(lambda: self._in_flight < int(self.depth) or self._error is not None)
+                if self._error is not None:
+                    break
+                self._in_flight += 1
+                self._seq += 1
+                seq = self._seq
+                chunk = data[offset:offset+self._next_chunk_size()]
+            callback = functools.partial(self._on_write_done, generation, seq, time.monotonic())
+            try:
+                characteristic.write_async(chunk, callback, command)
+            except Exception as e:
+                callback(e)
+            offset += len(chunk)
+
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._in_flight == 0, self.DRAIN_TIMEOUT):
+                # Writes of this send that complete later are ignored.
+                self._generation += 1
+                self._decrease(self._seq + 1)
+                raise tealblue.NotConnectedError('writes did not complete in %.1fs' % self.DRAIN_TIMEOUT)
+            error = self._error
+            self._error = None
+        if error is not None:
+            raise error
+
+    def _next_chunk_size(self):
+        return self.chunk_size
+
+    def _on_write_done(self, generation, seq, start, error):
+        latency = time.monotonic() - start
+        with self._cond:
+            self._in_flight -= 1
+            if generation != self._generation:
+                # Left over from a send() that gave up waiting.
+                pass
+            elif error is not None:
+                # This includes InProgressError (another write was still
+                # pending), which is only a signal to back off: the caller
+                # redoes the data.
+                if self._error is None:
+                    self._error = error
+                self._decrease(seq)
+            elif latency > self.SLOW_WRITE:
+                self._decrease(seq)
+            else:
+                self._increase()
+            self._cond.notify_all()
+
+    def on_round_trip(self, rtt):
+        '''
+        Feed the round trip time of a command and its notification.
+        '''
+        with self._cond:
+            if self.srtt is not None and rtt > 2 * self.srtt:
+                self._decrease(self._seq + 1)
+            if self.srtt is None:
+                self.srtt = rtt
+            else:
+                self.srtt = self.srtt * 7 / 8 + rtt / 8
+
+    def _increase(self):
+        if self.chunk_size < self.max_chunk:
+            self.chunk_size = min(self.chunk_size + self.MIN_CHUNK, self.max_chunk)
+        elif self._pipelined:
+            self.depth = min(self.depth + 1 / self.depth, self.MAX_DEPTH)
+
+    def _decrease(self, seq):
+        # Only react once to writes that were already in flight during the
+        # previous decrease.
+        if seq <= self._recover_seq:
+            return
+        self._recover_seq = self._seq
+        if self.depth >= 2:
+            self.depth = self.depth / 2
+        else:
+            self.depth = 1.0
+            self.chunk_size = max(self.MIN_CHUNK, self.chunk_size // 2 // self.MIN_CHUNK * self.MIN_CHUNK)
+
+def load_pacing(address):
+    if PACING_FILE is None:
+        return {}
+    try:
+        with open(PACING_FILE) as f:
+            return json.load(f).get(address, {})
+    except (OSError, ValueError):
+        return {}
+
+def save_pacing(address, pacer):
+    if PACING_FILE is None:
+        return
+    try:
+        with open(PACING_FILE) as f:
+            pacing = json.load(f)
+    except (OSError, ValueError):
+        pacing = {}
+    pacing[address] = {
+        'chunk_size': pacer.chunk_size,
+        'depth':      pacer.depth,
+        'srtt':       pacer.srtt,
+    }
+    try:
+        os.makedirs(os.path.dirname(PACING_FILE), exist_ok=True)
+        with open(PACING_FILE, 'w') as f:
+            json.dump(pacing, f, indent=2, sort_keys=True)
+    except OSError as e:
+        print('could not save pacing parameters:', e)
+
 def scan_device(adapter):
     with adapter.scan() as scanner:
         for device in scanner:
@@ -65,10 +233,11 @@ def lookup_device(adapter):
             return device
 
 class FirmwareUpdater:
-    def __init__(self, command, arg):
-        adapter = tealblue.TealBlue().find_adapter()
-
-        self.device = lookup_device(adapter)
+    def __init__(self, command, arg, device=None):
+        self.device = device
+        if not self.device:
+            adapter = tealblue.TealBlue().find_adapter()
+            self.device = lookup_device(adapter)
         if not self.device:
             print('Scanning...')
             self.device = scan_device(adapter)
@@ -87,15 +256,15 @@ class FirmwareUpdater:
         self.char_call = service.characteristics[DFU_CHARACTERISTIC_CALL]
         self.char_buff = service.characteristics[DFU_CHARACTERISTIC_BUFFER]
 
+        # Only one response may be outstanding at a time: a second one before
+        # the first has been handled means there is a race condition.
+        self.call_responses = self.char_call.subscribe(maxlen=1, overflow=tealblue.OVERFLOW_ERROR)
         self.char_call.start_notify()
-        self.char_call.on_notify = self.on_notify
 
         info_data = self.char_info.read()
-        self.info = DFUInfo(bytes(info_data))
+        self.info = DFUInfo(info_data)
         self.print_info();
 
-        self.call_event = threading.Event()
-
         if self.info.version != 1:
             print('Cannot flash this bootloader version.')
             sys.exit()
@@ -151,45 +320,68 @@ class FirmwareUpdater:
             char.write(value)
 
     def wait_for_response(self):
-        self.call_event.wait()
-        self.call_event.clear()
+        self.call_response = self.call_responses.get()
+        if self.call_response is None:
+            raise ValueError('DFU response subscription was closed')
         if self.call_response[0] != 0:
             raise ValueError('DFU command returned non-zero')
 
-    def on_notify(self, characteristic, value):
-        self.call_response = value
-        if self.call_event.is_set():
-            # This is not a true safety check as there is a race condition,
-            # but it will help discover race conditions if they exist.
-            raise ValueError('call event is set while entering event')
-        self.call_event.set()
-
     def write_hex(self, path):
         start = time.time()
         total_size = 0
+        pacer = self.new_pacer()
         for block in self.read_hex(path):
             total_size += len(block)
             for page in block.split_pages(self.info.page_size):
                 page_number = self.info.get_page_number(page.address)
                 print('writing page %d at address 0x%x with size %d' %(page_number, page.address, len(page)))
-
-                # erase page
-                self.do_dfu_command(struct.pack('BBH', COMMAND_ERASE_PAGE, 0, page_number), wait_for_response=True)
-
-                # fill the internal buffer
-                if self.char_buff:
-                    # high speed transfer possible
-                    for i in range(0, len(page), 20):
-                        self.do_dfu_write(self.char_buff, page.data[i:i+20])
-                else:
-                    # fall back to low speed on the same characteristic
-                    for i in range(0, len(page), 16):
-                        self.do_dfu_command(struct.pack('BBH16s', COMMAND_ADD_BUFFER, 0, 0, page.data[i:i+16]))
-
-                # write this page to flash
-                self.do_dfu_command(struct.pack('BBHH', COMMAND_WRITE_BUFFER, 0, page_number, int(len(page)/4)), wait_for_response=True)
+                # The buffer only appends, and writes that were in flight when
+                # a write failed may or may not have arrived, so on failure
+                # the whole page is redone.
+                for attempt in range(3):
+                    try:
+                        self.write_page(pacer, page, page_number)
+                        break
+                    except tealblue.NotConnectedError:
+                        if attempt == 2:
+                            raise
+                        print('Reconnecting...')
+                        self.device.connect()
+                    except tealblue.InProgressError:
+                        if attempt == 2:
+                            raise
+                        print('Write in progress, backing off...')
         duration = time.time() - start
         print('done, transfer took %.1fs (%.1fkB/s)' % (duration, total_size / duration / 1024))
+        self.save_pacer(pacer)
+
+    def new_pacer(self):
+        pacing = load_pacing(self.device.address)
+        pacer = Pacer(chunk_size=pacing.get('chunk_size'), depth=pacing.get('depth', 1))
+        pacer.srtt = pacing.get('srtt')
+        return pacer
+
+    def save_pacer(self, pacer):
+        print('pacing: chunk size %d, %.1f writes in flight' % (pacer.chunk_size, pacer.depth))
+        save_pacing(self.device.address, pacer)
+
+    def write_page(self, pacer, page, page_number):
+        # erase page
+        self.do_dfu_command(struct.pack('BBH', COMMAND_ERASE_PAGE, 0, page_number), wait_for_response=True)
+
+        # fill the internal buffer
+        if self.char_buff:
+            # high speed transfer possible
+            pacer.send(self.char_buff, page.data)
+        else:
+            # fall back to low speed on the same characteristic
+            for i in range(0, len(page), 16):
+                self.do_dfu_command(struct.pack('BBH16s', COMMAND_ADD_BUFFER, 0, 0, page.data[i:i+16]))
+
+        # write this page to flash
+        command_start = time.monotonic()
+        self.do_dfu_command(struct.pack('BBHH', COMMAND_WRITE_BUFFER, 0, page_number, int(len(page)/4)), wait_for_response=True)
+        pacer.on_round_trip(time.monotonic() - command_start)
 
     def read_hex(self, path):
         # Resources:
@@ -39,7 +39,7 @@ def run_terminal(rx):
         termios.tcsetattr(sys.stdin.fileno(), termios.TCSADRAIN, old_mode)
 
 def on_notify(characteristic, value):
-    data = bytes(value).replace(b'\n', b'\r\n').decode('utf-8')
+    data = value.replace(b'\n', b'\r\n').decode('utf-8')
     sys.stdout.write(data)
     sys.stdout.flush()
 
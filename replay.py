@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+
+# Replay a capture made with TEALBLUE_CAPTURE=<path> against the pynus/dfu
+# logic, using fake devices and characteristics instead of BlueZ.
+
+import tealblue
+import dfu
+import pynus
+import sys
+import time
+import threading
+import types
+import struct
+import cProfile
+import pstats
+
+KIND_NAMES = {
+    tealblue.CAPTURE_SESSION: 'session',
+    tealblue.CAPTURE_WRITE:  'write',
+    tealblue.CAPTURE_READ:   'read',
+    tealblue.CAPTURE_NOTIFY: 'notify',
+}
+
+class ReplayError(Exception):
+    pass
+
+class FakeCharacteristic(tealblue.Characteristic):
+    def __init__(self, replay, device, uuid):
+        self._replay = replay
+        self._device = device
+        self._teal = device._teal
+        self._path = None
+        self._properties = {'UUID': uuid}
+        self._subscriptions = []
+        self._subscriptions_lock = threading.Lock()
+
+        self.on_notify = None
+
+    def __repr__(self):
+        return '<replay.FakeCharacteristic uuid=%s>' % self.uuid
+
+    def __del__(self):
+        pass
+
+    def read(self):
+        return self._replay.read(self)
+
+    def write(self, value):
+        self._replay.write(self, value)
+
+    def write_async(self, value, callback, command=False):
+        try:
+            self._replay.write(self, value)
+        except Exception as e:
+            callback(e)
+        else:
+            callback(None)
+
+    def start_notify(self):
+        pass
+
+class FakeService:
+    def __init__(self, device, uuid):
+        self._device = device
+        self.uuid = uuid
+        self.characteristics = FakeCharacteristics(device)
+
+class FakeServices(dict):
+    def __init__(self, device):
+        self._device = device
+
+    def __missing__(self, uuid):
+        self[uuid] = FakeService(self._device, uuid)
+        return self[uuid]
+
+class FakeCharacteristics(dict):
+    # The capture doesn't record which service a characteristic belongs to, so
+    # every service shares the characteristics of the device.
+    def __init__(self, device):
+        self._device = device
+
+    def __missing__(self, uuid):
+        return self._device._characteristic(uuid)
+
+class FakeDevice:
+    def __init__(self, replay):
+        self._replay = replay
+        self._teal = types.SimpleNamespace(_capture=None)
+        self._characteristics = {}
+        self.services = FakeServices(self)
+        self.name = 'replay'
+        self.address = '00:00:00:00:00:00'
+        self.connected = True
+        self.services_resolved = True
+
+    def __repr__(self):
+        return '<replay.FakeDevice>'
+
+    def _characteristic(self, uuid):
+        if uuid not in self._characteristics:
+            self._characteristics[uuid] = FakeCharacteristic(self._replay, self, uuid)
+        return self._characteristics[uuid]
+
+    def connect(self):
+        self.connected = True
+
+    def disconnect(self):
+        self.connected = False
+
+    def resolve_services(self):
+        pass
+
+class ReplayPacer(dfu.Pacer):
+    '''
+    Sends chunks of the sizes in the capture instead of the ones it learns,
+    so that the writes line up with the recorded session. The learned chunk
+    size is kept separately and is not meaningful during a replay.
+    '''
+    def __init__(self, replay, uuid):
+        dfu.Pacer.__init__(self)
+        self._replay = replay
+        self._uuid = uuid
+
+    def _next_chunk_size(self):
+        return self._replay.next_write_size(self._uuid) or self.chunk_size
+
+class ReplayFirmwareUpdater(dfu.FirmwareUpdater):
+    def __init__(self, command, arg, replay):
+        self._replay = replay
+        dfu.FirmwareUpdater.__init__(self, command, arg, replay.device)
+
+    def new_pacer(self):
+        return ReplayPacer(self._replay, dfu.DFU_CHARACTERISTIC_BUFFER)
+
+    def save_pacer(self, pacer):
+        # The learned parameters don't mean anything for a replay.
+        pass
+
+class Replay:
+    '''
+    Drives fake characteristics from a capture. Every write or read of the
+    logic under test consumes the next write or read record of the capture,
+    after which the notifications that followed it are delivered. Writes and
+    reads that failed in the capture fail in the same way.
+    '''
+    def __init__(self, path, fast=False):
+        self.records = list(tealblue.read_capture(path))
+        self.fast = fast
+        self.device = FakeDevice(self)
+        self.mismatches = 0
+        self._pos = 0
+        self._start = None
+
+    def _start_session(self):
+        # Timestamps of different sessions can't be compared, so line up the
+        # next record with the current time.
+        self._start = None
+
+    def _wait_until(self, timestamp):
+        if self._start is None:
+            # Line up the first record with the current time.
+            self._start = time.monotonic() - timestamp
+        if self.fast:
+            return
+        delay = self._start + timestamp - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def _deliver_notifications(self):
+        while self._pos < len(self.records):
+            record = self.records[self._pos]
+            if record.kind == tealblue.CAPTURE_SESSION:
+                self._start_session()
+            elif record.kind == tealblue.CAPTURE_NOTIFY:
+                self._wait_until(record.timestamp)
+                self.device._characteristic(record.uuid)._notify(record.data)
+            else:
+                break
+            self._pos += 1
+
+    def _next(self, kind, characteristic):
+        self._deliver_notifications()
+        if self._pos >= len(self.records):
+            raise ReplayError('capture exhausted at %s of %s' % (KIND_NAMES[kind], characteristic.uuid))
+        record = self.records[self._pos]
+        if record.kind != kind or record.uuid != characteristic.uuid:
+            raise ReplayError('record %d: expected %s of %s, got %s of %s' % (self._pos, KIND_NAMES.get(record.kind, '?'), record.uuid, KIND_NAMES[kind], characteristic.uuid))
+        self._pos += 1
+        # Take as long as the recorded operation did.
+        self._wait_until(record.timestamp + record.duration)
+        if record.status == tealblue.CAPTURE_NOT_CONNECTED:
+            raise tealblue.NotConnectedError()
+        elif record.status != tealblue.CAPTURE_OK:
+            raise ReplayError('record %d: %s of %s failed in the capture' % (self._pos - 1, KIND_NAMES[kind], characteristic.uuid))
+        return record.data
+
+    def read(self, characteristic):
+        data = self._next(tealblue.CAPTURE_READ, characteristic)
+        self._deliver_notifications()
+        return data
+
+    def write(self, characteristic, value):
+        data = self._next(tealblue.CAPTURE_WRITE, characteristic)
+        if bytes(value) != data:
+            self.mismatches += 1
+            print('record %d: write of %s differs: expected %s, got %s' % (self._pos - 1, characteristic.uuid, data.hex(), bytes(value).hex()), file=sys.stderr)
+        self._deliver_notifications()
+
+    def next_write_size(self, uuid):
+        # The size of the next write if it is a write of this characteristic.
+        for record in self.records[self._pos:]:
+            if record.kind in (tealblue.CAPTURE_SESSION, tealblue.CAPTURE_NOTIFY):
+                continue
+            if record.kind == tealblue.CAPTURE_WRITE and record.uuid == uuid:
+                return len(record.data)
+            return None
+        return None
+
+    def replay_notifications(self, characteristic_uuid, callback):
+        # Feed all notifications of one characteristic to a callback,
+        # ignoring all other records.
+        characteristic = self.device._characteristic(characteristic_uuid)
+        for record in self.records:
+            if record.kind == tealblue.CAPTURE_SESSION:
+                self._start_session()
+            if record.kind != tealblue.CAPTURE_NOTIFY or record.uuid != characteristic_uuid:
+                continue
+            self._wait_until(record.timestamp)
+            callback(characteristic, record.data)
+        self._pos = len(self.records)
+
+STATUS_NAMES = {
+    tealblue.CAPTURE_OK:            '',
+    tealblue.CAPTURE_NOT_CONNECTED: 'not connected',
+    tealblue.CAPTURE_FAILED:        'failed',
+}
+
+def dump(records):
+    start = None
+    for record in records:
+        if record.kind == tealblue.CAPTURE_SESSION or start is None:
+            start = record.timestamp
+        if record.kind == tealblue.CAPTURE_SESSION:
+            wall_time, = struct.unpack('<d', record.data)
+            print('session started %s' % time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(wall_time)))
+            continue
+        line = '%10.6f %8.6f %-6s %s %s %s' % (record.timestamp - start, record.duration, KIND_NAMES.get(record.kind, '?'), record.uuid, record.data.hex(), STATUS_NAMES.get(record.status, '?'))
+        print(line.rstrip())
+
+def help():
+    print('Usage: replay.py [-f] [-p] <capture> <mode> [args...]')
+    print('-f                     replay at maximum speed instead of recorded speed')
+    print('-p                     profile the replayed logic')
+    print('Modes:')
+    print('dump                   print all records in the capture')
+    print('nus                    print the NUS console output')
+    print('dfu <command> [arg]    run a DFU command, e.g. "dfu flash <path>"')
+
+def main():
+    args = sys.argv[1:]
+    fast = False
+    profile = False
+    while args and args[0].startswith('-'):
+        flag = args.pop(0)
+        if flag == '-f':
+            fast = True
+        elif flag == '-p':
+            profile = True
+        else:
+            help()
+            return
+    if len(args) < 2:
+        help()
+        return
+    path, mode = args[:2]
+
+    # Don't let replayed sessions affect the pacing of real devices.
+    dfu.PACING_FILE = None
+
+    replay = Replay(path, fast)
+    if mode == 'dump':
+        dump(replay.records)
+        return
+    elif mode == 'nus':
+        run = lambda: replay.replay_notifications(pynus.NUS_CHARACTERISTIC_TX, pynus.on_notify)
+    elif mode == 'dfu':
+        command = args[2] if len(args) > 2 else None
+        arg = args[3] if len(args) > 3 else None
+        run = lambda: ReplayFirmwareUpdater(command, arg, replay)
+    else:
+        help()
+        return
+
+    start = time.monotonic()
+    profiler = None
+    if profile:
+        profiler = cProfile.Profile()
+    failed = False
+    try:
+        if profiler is not None:
+            profiler.runcall(run)
+        else:
+            run()
+    except ReplayError as e:
+        print('replay failed: %s' % e, file=sys.stderr)
+        failed = True
+    duration = time.monotonic() - start
+    print('replayed %d of %d records in %.2fs, %d mismatches' % (replay._pos, len(replay.records), duration, replay.mismatches), file=sys.stderr)
+    if profiler is not None:
+        pstats.Stats(profiler, stream=sys.stderr).sort_stats('cumulative').print_stats(25)
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
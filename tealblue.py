@@ -6,12 +6,23 @@ import dbus.mainloop.glib
 from gi.repository import GLib
 import threading
 import queue
+import collections
 import traceback
 import time
+import os
+import struct
+import uuid
+import atexit
 
 class NotConnectedError(Exception):
     pass
 
+class InProgressError(Exception):
+    pass
+
+class BufferOverflowError(Exception):
+    pass
+
 class DBusInvalidArgsException(dbus.exceptions.DBusException):
     _dbus_error_name = 'org.freedesktop.DBus.Error.InvalidArgs'
 
@@ -22,12 +33,96 @@ def format_uuid(uuid):
         uuid = '%04X' % uuid
     return uuid
 
+# Capture file format: a magic header followed by records, each a fixed-size
+# header (monotonic start time, duration, kind, status, 128-bit UUID, length)
+# and the raw bytes. Every session starts with a session record holding the
+# wall clock time, as monotonic timestamps of different sessions can't be
+# compared.
+CAPTURE_MAGIC  = b'TBCAP002'
+CAPTURE_RECORD = struct.Struct('<dfBB16sH')
+
+CAPTURE_SESSION = ord('S')
+CAPTURE_WRITE   = ord('W')
+CAPTURE_READ    = ord('R')
+CAPTURE_NOTIFY  = ord('N')
+
+CAPTURE_OK            = 0
+CAPTURE_NOT_CONNECTED = 1
+CAPTURE_FAILED        = 2
+
+CaptureRecord = collections.namedtuple('CaptureRecord', 'timestamp duration kind status uuid data')
+
+class Capture:
+    '''
+    Append-only binary log of all GATT traffic, for analysing and replaying
+    sessions afterwards.
+    '''
+    def __init__(self, path):
+        self._file = open(path, 'ab')
+        if self._file.tell() == 0:
+            self._file.write(CAPTURE_MAGIC)
+        self._lock = threading.Lock()
+        self._uuids = {str(uuid.UUID(int=0)): bytes(16)}
+        atexit.register(self.close)
+        self.record(CAPTURE_SESSION, str(uuid.UUID(int=0)), struct.pack('<d', time.time()), time.monotonic())
+
+    def record(self, kind, uuid_str, data, start, duration=0.0, status=CAPTURE_OK):
+        uuid_bytes = self._uuids.get(uuid_str)
+        if uuid_bytes is None:
+            uuid_bytes = uuid.UUID(uuid_str).bytes
+            self._uuids[uuid_str] = uuid_bytes
+        header = CAPTURE_RECORD.pack(start, duration, kind, status, uuid_bytes, len(data))
+        with self._lock:
+            if self._file.closed:
+                return
+            self._file.write(header)
+            self._file.write(data)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+def read_capture(path):
+    '''
+    Read a capture file, yielding a CaptureRecord for every record.
+    '''
+    with open(path, 'rb') as f:
+        if f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError('not a tealblue capture file: %s' % path)
+        while True:
+            header = f.read(CAPTURE_RECORD.size)
+            if len(header) < CAPTURE_RECORD.size:
+                # End of file, or a truncated record at the end of the log.
+                return
+            timestamp, duration, kind, status, uuid_bytes, length = CAPTURE_RECORD.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                return
+            yield CaptureRecord(timestamp, duration, kind, status, str(uuid.UUID(bytes=uuid_bytes)), data)
+
+def to_bytes(value):
+    '''
+    Return a bytes-like object as bytes, without copying if it already is.
+    dbus-python marshals bytes as a single 'ay' block, but other buffers (such
+    as memoryview) one element at a time.
+    '''
+    if isinstance(value, bytes):
+        return value
+    return bytes(value)
+
 class TealBlue:
-    def __init__(self):
+    def __init__(self, capture=None):
         self._bus = dbus.SystemBus()
         self._bluez = dbus.Interface(self._bus.get_object('org.bluez', '/'),
                                      'org.freedesktop.DBus.ObjectManager')
 
+        # Record all GATT traffic when requested.
+        if capture is None:
+            capture = os.environ.get('TEALBLUE_CAPTURE')
+        self._capture = None
+        if capture:
+            self._capture = Capture(capture)
+
     def find_adapter(self):
         # find the first adapter
         objects = self._bluez.GetManagedObjects()
@@ -246,18 +341,124 @@ class Service:
     def uuid(self):
         return str(self._properties['UUID'])
 
+# Overflow policies for Subscription.
+OVERFLOW_DROP_OLDEST = 'drop-oldest'
+OVERFLOW_BLOCK       = 'block'
+OVERFLOW_ERROR       = 'error'
+
+class Subscription:
+    '''
+    A bounded ring buffer of notifications from a single characteristic.
+    Notifications are put in it from the D-Bus thread and can be retrieved from
+    any other thread using get() or drain().
+
+    Note that with OVERFLOW_BLOCK a full buffer blocks the thread delivering
+    notifications, which for D-Bus is the main loop thread. That stalls every
+    signal and async reply (including write_async() completions), so the
+    consumer must never wait on D-Bus while the buffer is full or it will
+    deadlock.
+    '''
+    def __init__(self, characteristic, maxlen=64, overflow=OVERFLOW_DROP_OLDEST):
+        if maxlen < 1:
+            raise ValueError('maxlen must be at least 1, got %r' % maxlen)
+        if overflow not in (OVERFLOW_DROP_OLDEST, OVERFLOW_BLOCK, OVERFLOW_ERROR):
+            raise ValueError('unknown overflow policy: %r' % overflow)
+        self._characteristic = characteristic
+        self._buffer = collections.deque()
+        self._cond = threading.Condition()
+        self._overflowed = False
+        self._closed = False
+        self.maxlen = maxlen
+        self.overflow = overflow
+        self.dropped = 0
+
+    def __repr__(self):
+        return '<tealblue.Subscription uuid=%s queued=%d dropped=%d>' % (self._characteristic.uuid, len(self._buffer), self.dropped)
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def _put(self, value):
+        # Called from the D-Bus thread.
+        with self._cond:
+            if len(self._buffer) >= self.maxlen:
+                if self.overflow == OVERFLOW_BLOCK:
+                    while len(self._buffer) >= self.maxlen and not self._closed:
+                        self._cond.wait()
+                    if self._closed:
+                        return
+                else:
+                    # Drop the oldest packet, both for drop-oldest and error.
+                    # The error is raised in the consumer, not here, as
+                    # raising in the D-Bus thread wouldn't reach anyone.
+                    self._buffer.popleft()
+                    self.dropped += 1
+                    if self.overflow == OVERFLOW_ERROR:
+                        self._overflowed = True
+            self._buffer.append(value)
+            self._cond.notify_all()
+
+    def _check_overflow(self):
+        if self._overflowed:
+            self._overflowed = False
+            raise BufferOverflowError('notification buffer overflowed (%d dropped)' % self.dropped)
+
+    def get(self, timeout=None):
+        '''
+        Return the oldest queued notification, waiting for one to arrive if
+        necessary. Returns None on timeout or when the subscription is closed.
+        '''
+        with self._cond:
+            self._check_overflow()
+            if not self._cond.wait_for(lambda: self._buffer or self._closed, timeout):
+                return None
+            if not self._buffer:
+                return None
+            value = self._buffer.popleft()
+            self._cond.notify_all()
+            return value
+
+    def drain(self):
+        '''
+        Return all queued notifications at once (possibly an empty list),
+        without waiting.
+        '''
+        with self._cond:
+            self._check_overflow()
+            values = list(self._buffer)
+            self._buffer.clear()
+            self._cond.notify_all()
+            return values
+
+    def close(self):
+        self._characteristic.unsubscribe(self)
+
 class Characteristic:
+    # Timeout of write_async(), after which the connection is checked. Much
+    # shorter than the default D-Bus timeout, so hung writes are noticed.
+    WRITE_TIMEOUT = 2.0
+
     def __init__(self, teal, device, path, properties):
         self._device = device
         self._teal = teal
         self._path = path
         self._properties = properties
+        self._subscriptions = []
+        self._subscriptions_lock = threading.Lock()
 
         self.on_notify = None
 
         self._char = dbus.Interface(teal._bus.get_object('org.bluez', path), 'org.bluez.GattCharacteristic1')
         char_props = dbus.Interface(self._char, 'org.freedesktop.DBus.Properties')
-        self._signal_receiver = char_props.connect_to_signal('PropertiesChanged', lambda itf, ch, inv: self._on_prop_changed(itf, ch, inv))
+        # Receive 'ay' values as dbus.ByteArray (a bytes subclass) so they can
+        # be passed on without conversion.
+        self._signal_receiver = char_props.connect_to_signal('PropertiesChanged', lambda itf, ch, inv: self._on_prop_changed(itf, ch, inv), byte_arrays=True)
 
     def __repr__(self):
         return '<tealblue.Characteristic device=%s uuid=%s>' % (self._device.address, self.uuid)
@@ -267,23 +468,123 @@ class Characteristic:
 
     def _on_prop_changed(self, properties, changed_props, invalidated_props):
         for key, value in changed_props.items():
-            self._properties[key] = bytes(value)
+            self._properties[key] = value
 
-        if 'Value' in changed_props and self.on_notify is not None:
-            self.on_notify(self, changed_props['Value'])
+        if 'Value' in changed_props:
+            self._notify(changed_props['Value'])
+
+    def _record(self, kind, value, start, error=None):
+        capture = self._teal._capture
+        if capture is None:
+            return
+        status = CAPTURE_OK
+        if isinstance(error, NotConnectedError):
+            status = CAPTURE_NOT_CONNECTED
+        elif error is not None:
+            status = CAPTURE_FAILED
+        capture.record(kind, self.uuid, value, start, time.monotonic() - start, status)
+
+    def _notify(self, value):
+        self._record(CAPTURE_NOTIFY, value, time.monotonic())
+        for subscription in self._subscriptions:
+            subscription._put(value)
+        if self.on_notify is not None:
+            self.on_notify(self, value)
+
+    def subscribe(self, maxlen=64, overflow=OVERFLOW_DROP_OLDEST):
+        '''
+        Return a new Subscription that receives every notification of this
+        characteristic. Multiple subscriptions may exist at the same time.
+        See Subscription for the hazards of OVERFLOW_BLOCK.
+        '''
+        subscription = Subscription(self, maxlen, overflow)
+        # Replace the list instead of modifying it, so the thread delivering
+        # notifications can iterate over it without locking. The lock only
+        # serializes concurrent subscribe() and unsubscribe() calls.
+        with self._subscriptions_lock:
+            self._subscriptions = self._subscriptions + [subscription]
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with subscription._cond:
+            subscription._closed = True
+            subscription._cond.notify_all()
+        with self._subscriptions_lock:
+            self._subscriptions = [s for s in self._subscriptions if s is not subscription]
 
     def read(self):
-        return bytes(self._char.ReadValue({}))
+        start = time.monotonic()
+        try:
+            value = self._char.ReadValue({}, byte_arrays=True)
+        except Exception as e:
+            self._record(CAPTURE_READ, b'', start, e)
+            raise
+        self._record(CAPTURE_READ, value, start)
+        return value
 
     def write(self, value):
+        value = to_bytes(value)
+        start = time.monotonic()
+        try:
+            self._write_dbus(value)
+        except Exception as e:
+            self._record(CAPTURE_WRITE, value, start, e)
+            raise
+        self._record(CAPTURE_WRITE, value, start)
+
+    def write_async(self, value, callback, command=False):
+        '''
+        Start a write without waiting for it to complete. The callback is
+        called with None on success or with the exception on failure, usually
+        from the D-Bus thread.
+
+        With command=True the value is sent as a write command (for
+        write-without-response characteristics), of which multiple can be in
+        flight. Otherwise BlueZ picks the write type, and rejects a second
+        write request while one is pending with InProgressError.
+        '''
+        value = to_bytes(value)
+        options = {}
+        if command:
+            options['type'] = 'command'
+        start = time.monotonic()
+        def finish(error):
+            self._record(CAPTURE_WRITE, value, start, error)
+            callback(error)
+        def check_connected(error):
+            # Same workaround as in _write_dbus: if the write took very long
+            # (or timed out), the connection may have broken without a
+            # proper error.
+            if isinstance(error, NotConnectedError) or time.monotonic() - start <= 0.5:
+                finish(error)
+                return
+            self._device._device_props.Get('org.bluez.Device1', 'Connected',
+                timeout=self.WRITE_TIMEOUT,
+                reply_handler=lambda connected: finish(error if connected else NotConnectedError()),
+                error_handler=lambda e: finish(error if error is not None else self._convert_error(e)))
+        def reply_handler():
+            check_connected(None)
+        def error_handler(e):
+            check_connected(self._convert_error(e))
+        self._char.WriteValue(value, options, timeout=self.WRITE_TIMEOUT,
+                              reply_handler=reply_handler, error_handler=error_handler)
+
+    def _convert_error(self, e):
+        if e.get_dbus_name() == 'org.bluez.Error.Failed' and e.get_dbus_message() == 'Not connected':
+            return NotConnectedError()
+        if e.get_dbus_name() == 'org.bluez.Error.InProgress':
+            return InProgressError(e.get_dbus_message())
+        return e # some other error
+
+    def _write_dbus(self, value):
         start = time.time()
         try:
             self._char.WriteValue(value, {})
         except dbus.DBusException as e:
-            if e.get_dbus_name() == 'org.bluez.Error.Failed' and e.get_dbus_message() == 'Not connected':
-                raise NotConnectedError()
-            else:
-                raise # some other error
+            error = self._convert_error(e)
+            if error is e:
+                raise
+            raise error
 
         # Workaround: if the write took very long, it is possible the connection
         # broke (without causing an exception). So check whether we are still
@@ -300,6 +601,10 @@ class Characteristic:
     def uuid(self):
         return str(self._properties['UUID'])
 
+    @property
+    def flags(self):
+        return [str(f) for f in self._properties.get('Flags', [])]
+
 class Advertisement(dbus.service.Object):
     PATH = '/com/github/aykevl/pynus/advertisement'
 